@@ -1,68 +1,180 @@
+import asyncio
+import gzip
+import hashlib
 import os
+import time
+from contextlib import asynccontextmanager, suppress
 from datetime import datetime
-from typing import Literal, Dict, Optional
-
-import requests
-from fastapi import FastAPI
+from typing import Literal, Dict, Optional, Set
+
+import httpx
+import msgspec
+from redis import asyncio as aioredis
+from redis.exceptions import RedisError
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import ORJSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from pydantic import BaseModel
+from starlette.datastructures import Headers
 
 
 
 ESP32_BASE_URL = os.getenv("ESP32_BASE_URL", "http://192.168.1.50")
-FORWARD_TO_ESP32 = os.getenv("FORWARD_TO_ESP32", "false").lower() == "true"
+FORWARD_TO_ESP32 = os.getenv("FORWARD_TO_ESP32", "false").strip().lower() in {"true", "1", "yes"}
+# Si hay REDIS_URL, el estado se comparte entre workers a través de Redis
+REDIS_URL = os.getenv("REDIS_URL")
+
 
+# Cliente HTTP y cola de comandos compartidos, se crean en el lifespan de la app
+client: Optional[httpx.AsyncClient] = None
+ESP_QUEUE_SIZE = 256
+# Se crea al importar (en 3.10+ la cola no queda atada a un loop);
+# el lifespan solo arranca el worker que la vacía
+esp_queue: asyncio.Queue = asyncio.Queue(maxsize=ESP_QUEUE_SIZE)
+# Un comando que esperó más que esto ya no se manda (no abrir una puerta minutos tarde)
+ESP_COMMAND_MAX_AGE = 5.0
 
-def send_command_to_esp(path: str) -> None:
+
+async def send_command_to_esp(path: str) -> None:
     """
-    Envía el comando al ESP32 (por ejemplo /principal/open)
-    si FORWARD_TO_ESP32=True. En Render normalmente estará en False.
+    Envía el comando al ESP32 (por ejemplo /principal/open).
+    Lo llama esp_worker, fuera del request.
     """
-    if not FORWARD_TO_ESP32:
-        return
-
     try:
         url = f"{ESP32_BASE_URL}{path}"
         print(f"[INFO] Enviando comando al ESP32: {url}")
-        requests.get(url, timeout=3)
+        await client.get(url)
     except Exception as e:
         print(f"[WARN] No se pudo contactar al ESP32 en {path}: {e}")
 
 
+# La decisión de reenviar al ESP32 se toma una sola vez, al importar
+if FORWARD_TO_ESP32:
+    def enqueue_command(path: str) -> None:
+        """
+        Encola un comando para el ESP32 sin bloquear.
+        Si la cola está llena se descarta el comando más viejo.
+        """
+        item = (path, time.monotonic())
+        try:
+            esp_queue.put_nowait(item)
+        except asyncio.QueueFull:
+            dropped, _ = esp_queue.get_nowait()
+            print(f"[WARN] Cola del ESP32 llena, se descarta {dropped}")
+            esp_queue.put_nowait(item)
+else:
+    def enqueue_command(path: str) -> None:
+        """FORWARD_TO_ESP32=False (lo normal en Render): no se encola nada."""
+
+
+async def esp_worker() -> None:
+    """
+    Manda los comandos encolados de a uno, reutilizando la conexión.
+    Los que esperaron más de ESP_COMMAND_MAX_AGE (ESP32 caído) se descartan
+    y se avisa por /ws que el ESP32 no los recibió.
+    """
+    while True:
+        path, enqueued_at = await esp_queue.get()
+        if time.monotonic() - enqueued_at > ESP_COMMAND_MAX_AGE:
+            print(f"[WARN] Comando viejo para el ESP32, se descarta {path}")
+            await broadcast({
+                "type": "esp_error",
+                "path": path,
+                "message": "El ESP32 no recibió el comando",
+            })
+            continue
+        await send_command_to_esp(path)
+
+
+# ==========================
+# AVISOS POR WEBSOCKET
+# ==========================
+
+# Clientes conectados a /ws (de este worker)
+connected: Set[WebSocket] = set()
+_send_tasks: Set[asyncio.Task] = set()
+# Con Redis los cambios pasan por este canal, así llegan a los clientes de todos los workers
+EVENTS_CHANNEL = "house:events"
+# Un cliente que no recibe en este tiempo se desconecta
+WS_SEND_TIMEOUT = 2.0
+
+
+async def broadcast(message: dict) -> None:
+    """Avisa a los clientes de /ws algo que no hay que guardar en Redis (ver persist)."""
+    await persist({}, message)
+
+
+def fan_out(data: str) -> None:
+    """Manda el mensaje ya codificado a los clientes de este worker, sin bloquear."""
+    for websocket in list(connected):
+        task = asyncio.create_task(_send_to_client(websocket, data))
+        _send_tasks.add(task)
+        task.add_done_callback(_send_tasks.discard)
+
+
+async def _send_to_client(websocket: WebSocket, data: str) -> None:
+    try:
+        await asyncio.wait_for(websocket.send_text(data), WS_SEND_TIMEOUT)
+    except Exception:
+        # Cliente trabado o desconectado: se saca para no acumular envíos
+        if websocket in connected:
+            connected.discard(websocket)
+            with suppress(Exception):
+                await asyncio.wait_for(websocket.close(), WS_SEND_TIMEOUT)
+
+
+async def redis_listener() -> None:
+    """Reparte a los clientes locales los cambios publicados por cualquier worker."""
+    while True:
+        try:
+            async with redis_client.pubsub() as pubsub:
+                await pubsub.subscribe(EVENTS_CHANNEL)
+                async for message in pubsub.listen():
+                    if message["type"] == "message":
+                        fan_out(message["data"])
+        except RedisError as e:
+            print(f"[WARN] Se perdió la suscripción a Redis, reintentando: {e}")
+            await asyncio.sleep(1)
+
+
 # ==========================
 # MODELOS DE ESTADO
 # ==========================
+# El estado vive en msgspec.Struct (sin validación en cada escritura).
+# Pydantic se usa solo para los bodies de entrada (UltraDistanceUpdate, DhtUpdate).
+# gc=False: son datos planos sin ciclos, el GC no necesita seguirlos.
 
-class DoorState(BaseModel):
+class DoorState(msgspec.Struct, gc=False):
     name: str
     is_open: bool
     last_update: datetime
 
 
-class LightState(BaseModel):
+class LightState(msgspec.Struct, gc=False):
     room: Literal["cocina", "sala", "dorm"]
     is_on: bool
     last_update: datetime
 
 
-class PirState(BaseModel):
+class PirState(msgspec.Struct, gc=False):
     active: bool
     last_update: datetime
 
 
-class UltraState(BaseModel):
+class UltraState(msgspec.Struct, gc=False):
     active: bool
     last_update: datetime
     last_distance_cm: Optional[float] = None
 
 
-class DhtState(BaseModel):
+class DhtState(msgspec.Struct, gc=False):
     temperature: Optional[float] = None
     humidity: Optional[float] = None
     last_update: Optional[datetime] = None
 
 
-class HouseState(BaseModel):
+class HouseState(msgspec.Struct, gc=False):
     doors: Dict[str, DoorState]
     lights: Dict[str, LightState]
     pir: PirState
@@ -71,49 +183,70 @@ class HouseState(BaseModel):
     modo_seguro: bool
 
 
+# Encoder reutilizable (mantiene su buffer interno entre llamadas).
+# Codifica todas las respuestas de estado y los avisos de /ws: recibe
+# los Structs (y dicts con Structs) tal cual, sin pasos previos en Python.
+JSON_ENCODER = msgspec.json.Encoder()
+
+
+class MsgspecJSONResponse(Response):
+    """
+    Respuesta JSON serializada con msgspec, para devolver el estado
+    (Structs, dicts con Structs, datetimes) sin pasar por Pydantic.
+    """
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return JSON_ENCODER.encode(content)
+
+
 # ==========================
 # ESTADO EN MEMORIA
 # ==========================
 
+# datetime y no time.time_ns(): msgspec serializa datetime en C, así que
+# guardar enteros y formatearlos en Python al responder saldría más caro.
 now = datetime.utcnow  # helper para timestamps
 
+started_at = now()  # un solo timestamp para todo el estado inicial
+
 state = HouseState(
     doors={
         "principal": DoorState(
             name="principal",
             is_open=False,
-            last_update=now()
+            last_update=started_at
         ),
         "garage": DoorState(
             name="garage",
             is_open=False,
-            last_update=now()
+            last_update=started_at
         ),
     },
     lights={
         "cocina": LightState(
             room="cocina",
             is_on=False,
-            last_update=now()
+            last_update=started_at
         ),
         "sala": LightState(
             room="sala",
             is_on=False,
-            last_update=now()
+            last_update=started_at
         ),
         "dorm": LightState(
             room="dorm",
             is_on=False,
-            last_update=now()
+            last_update=started_at
         ),
     },
     pir=PirState(
         active=False,
-        last_update=now()
+        last_update=started_at
     ),
     ultra=UltraState(
         active=False,
-        last_update=now(),
+        last_update=started_at,
         last_distance_cm=None
     ),
     dht=DhtState(
@@ -124,10 +257,282 @@ state = HouseState(
     modo_seguro=False,
 )
 
+# Referencias directas a cada dispositivo, resueltas una sola vez al importar
+PRINCIPAL = state.doors["principal"]
+GARAGE = state.doors["garage"]
+COCINA = state.lights["cocina"]
+SALA = state.lights["sala"]
+DORM = state.lights["dorm"]
+PIR = state.pir
+ULTRA = state.ultra
+DHT = state.dht
+
+# JSON de /status ya codificado; se regenera solo cuando cambia el estado.
+# El ETag sale del contenido, así coincide entre workers con el mismo estado.
+_status_cache: Optional[bytes] = None
+_status_gzip: Optional[bytes] = None
+_status_etag: Optional[str] = None
+
+
+def _invalidate_status() -> None:
+    """Marca el cache de /status como viejo. Llamar después de cada escritura."""
+    global _status_cache, _status_gzip
+    _status_cache = None
+    _status_gzip = None
+
+
+def _rebuild_status() -> bytes:
+    global _status_cache, _status_etag
+    _status_cache = JSON_ENCODER.encode(state)
+    _status_etag = f'W/"{hashlib.blake2b(_status_cache, digest_size=8).hexdigest()}"'
+    return _status_cache
+
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    """
+    If-None-Match puede traer varias etiquetas separadas por coma o "*".
+    Se comparan en forma débil (sin el prefijo W/).
+    """
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    tags = {tag.strip().removeprefix("W/") for tag in header.split(",")}
+    return "*" in tags or etag.removeprefix("W/") in tags
+
+
+def accepts_gzip(accept_encoding: str) -> bool:
+    """
+    Lee Accept-Encoding como lista de codificaciones con q-value:
+    "gzip;q=0" la rechaza y "x-gzip" no cuenta como gzip.
+    """
+    accepted = {}
+    for part in accept_encoding.split(","):
+        coding, _, params = part.partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
+    return accepted.get("gzip", accepted.get("*", 0.0)) > 0
+
+
+class NegotiatedGZipMiddleware(GZipMiddleware):
+    """
+    GZipMiddleware que respeta los q-values de Accept-Encoding (gzip;q=0).
+    /status ya sale comprimido de su propio cache y no pasa por acá.
+    """
+
+    excluded_paths = {"/status"}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await super().__call__(scope, receive, send)
+            return
+        if scope["path"] in self.excluded_paths:
+            await self.app(scope, receive, send)
+            return
+        if not accepts_gzip(Headers(scope=scope).get("accept-encoding", "")):
+            # GZipMiddleware solo busca "gzip" en el header: se saca para que no comprima
+            scope = {**scope, "headers": [
+                (name, b", ".join(
+                    part for part in value.split(b",") if b"gzip" not in part.lower()
+                ).strip() if name == b"accept-encoding" else value)
+                for name, value in scope["headers"]
+            ]}
+        await super().__call__(scope, receive, send)
+
+
+def _status_gzipped(body: bytes) -> bytes:
+    """Versión gzip del cache de /status, se comprime una vez por cambio."""
+    global _status_gzip
+    if _status_gzip is None:
+        _status_gzip = gzip.compress(body, compresslevel=6)
+    return _status_gzip
+
+
+# ==========================
+# ESTADO COMPARTIDO (REDIS, opcional)
+# ==========================
+# Cada dispositivo es un hash "house:<dispositivo>" y modo_seguro vive en "house".
+# Las escrituras guardan solo los campos que cambian; las lecturas refrescan
+# la copia local desde Redis como mucho cada REDIS_SYNC_INTERVAL segundos.
+
+redis_client: Optional[aioredis.Redis] = None
+
+REDIS_KEYS = {
+    "house:principal": PRINCIPAL,
+    "house:garage": GARAGE,
+    "house:cocina": COCINA,
+    "house:sala": SALA,
+    "house:dorm": DORM,
+    "house:pir": PIR,
+    "house:ultra": ULTRA,
+    "house:dht": DHT,
+}
+
+REDIS_SYNC_INTERVAL = 0.1
+_last_sync = 0.0
+# Cuándo cambió modo_seguro en este worker (HouseState no tiene last_update)
+_modo_seguro_update: Optional[datetime] = None
+
+
+def _to_redis(value):
+    """Redis solo guarda texto y números: bool -> 0/1, datetime -> ISO 8601."""
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+async def persist(updates: Dict[str, dict], *events: dict) -> None:
+    """
+    Guarda en Redis los campos cambiados, por ejemplo
+    {"house:principal": {"is_open": True, "last_update": ...}},
+    y avisa los eventos a los clientes de /ws. Cada evento se codifica una sola vez.
+
+    Con Redis, los HSET y los PUBLISH a EVENTS_CHANNEL van en el mismo
+    pipeline (un solo viaje) y cada worker reparte los eventos a sus
+    clientes (redis_listener). Si Redis no responde, el cambio queda solo
+    en este worker y los eventos se reparten acá.
+    """
+    if redis_client is None and not connected:
+        return
+    data = [JSON_ENCODER.encode(event).decode() for event in events]
+    if redis_client is not None:
+        try:
+            async with redis_client.pipeline(transaction=False) as pipe:
+                for key, fields in updates.items():
+                    pipe.hset(key, mapping={f: _to_redis(v) for f, v in fields.items()})
+                for message in data:
+                    pipe.publish(EVENTS_CHANNEL, message)
+                await pipe.execute()
+            return
+        except RedisError as e:
+            print(f"[WARN] No se pudo guardar el estado en Redis: {e}")
+    for message in data:
+        fan_out(message)
+
+
+def set_modo_seguro(value: bool, ts: datetime) -> None:
+    """Cambia modo_seguro y recuerda cuándo, para no pisarlo con datos viejos."""
+    global _modo_seguro_update
+    state.modo_seguro = value
+    _modo_seguro_update = ts
+
+
+def _is_older(remote: Optional[datetime], local: Optional[datetime]) -> bool:
+    return remote is not None and local is not None and remote < local
+
+
+async def refresh_state() -> None:
+    """
+    Trae de Redis lo que escribieron los otros workers y lo copia
+    sobre los Structs locales (sin reemplazarlos).
+    Si Redis no responde o un hash trae valores inválidos, se queda
+    con el estado local para esa parte.
+    """
+    global _last_sync
+    if redis_client is None:
+        return
+    ts = time.monotonic()
+    if ts - _last_sync < REDIS_SYNC_INTERVAL:
+        return
+    _last_sync = ts
+
+    keys = list(REDIS_KEYS)
+    try:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.hgetall(key)
+            pipe.hgetall("house")
+            *hashes, house = await pipe.execute()
+    except RedisError as e:
+        # Se sigue respondiendo con el estado local
+        print(f"[WARN] No se pudo leer el estado de Redis: {e}")
+        return
+
+    # Mientras se esperaba a Redis pudo entrar una escritura local más nueva:
+    # un hash con last_update más viejo que el local no se aplica.
+    changed = False
+    for key, data in zip(keys, hashes):
+        if not data:
+            continue
+        local = REDIS_KEYS[key]
+        try:
+            merged = msgspec.convert(
+                {**msgspec.structs.asdict(local), **data},
+                type(local),
+                strict=False,
+            )
+        except msgspec.ValidationError as e:
+            # Un valor inválido en Redis no tumba /status: se ignora ese hash
+            print(f"[WARN] Valor inválido en Redis ({key}), se ignora: {e}")
+            continue
+        if _is_older(merged.last_update, local.last_update):
+            continue
+        if merged != local:
+            for field in local.__struct_fields__:
+                setattr(local, field, getattr(merged, field))
+            changed = True
+
+    if "modo_seguro" in house and "last_update" in house:
+        modo = house["modo_seguro"] == "1"
+        try:
+            modo_update = datetime.fromisoformat(house["last_update"])
+        except ValueError as e:
+            print(f"[WARN] Valor inválido en Redis (house), se ignora: {e}")
+            modo_update = None
+        if modo_update is not None and not _is_older(modo_update, _modo_seguro_update) and state.modo_seguro != modo:
+            set_modo_seguro(modo, modo_update)
+            changed = True
+    if changed:
+        _invalidate_status()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global client, redis_client
+    # Keep-alive: se reutiliza la conexión TCP con el ESP32 entre comandos
+    client = httpx.AsyncClient(
+        timeout=3,
+        headers={"Connection": "keep-alive"},
+        limits=httpx.Limits(
+            max_connections=8,
+            max_keepalive_connections=8,
+            keepalive_expiry=30,
+        ),
+    )
+    # Sin reenvío al ESP32 no hay nada que vaciar
+    worker = asyncio.create_task(esp_worker()) if FORWARD_TO_ESP32 else None
+    listener = None
+    if REDIS_URL:
+        redis_client = aioredis.from_url(REDIS_URL, decode_responses=True)
+        listener = asyncio.create_task(redis_listener())
+    yield
+    for task in (worker, listener):
+        if task is not None:
+            task.cancel()
+            with suppress(asyncio.CancelledError):
+                await task
+    await client.aclose()
+    if redis_client is not None:
+        await redis_client.aclose()
+
+
 app = FastAPI(
     title="Casa IoT Backend",
     version="1.0.0",
     description="API para controlar y monitorear la Casa IoT (puertas, luces, sensores, etc.)",
+    default_response_class=ORJSONResponse,  # solo para la documentación OpenAPI
+    lifespan=lifespan,
 )
 
 # CORS para permitir que tu front (HTML/JS) llame al backend
@@ -139,231 +544,138 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Comprime respuestas grandes (por ejemplo /modo/seguro) para clientes en redes lentas
+app.add_middleware(NegotiatedGZipMiddleware, minimum_size=256, compresslevel=6)
+
 
 # ==========================
 # ROOT
 # ==========================
 
-@app.get("/")
-def root():
-    return {
+@app.get("/", response_model=None)
+async def root():
+    return MsgspecJSONResponse({
         "message": "Casa IoT backend OK",
         "docs": "/docs",
         "status": "/status"
-    }
+    })
 
 
 # ==========================
 # ENDPOINT GENERAL DE ESTADO
 # ==========================
 
-@app.get("/status", response_model=HouseState)
-def get_status():
+@app.get("/status", response_model=None)
+async def get_status(request: Request):
     """
     Devuelve el estado completo de la casa:
     puertas, luces, PIR, ultrasonido, DHT y modo seguro.
+    Responde 304 si el cliente ya tiene esta versión (If-None-Match).
     """
-    return state
-
-
-# ==========================
-# PUERTA PRINCIPAL  (ESP: /principal/open y /principal/close)
-# ==========================
-
-@app.get("/principal/open")
-def principal_open():
-    state.doors["principal"].is_open = True
-    state.doors["principal"].last_update = now()
-    state.modo_seguro = False  # si abres algo, ya no estás en modo seguro
-    send_command_to_esp("/principal/open")
-    return {
-        "message": "Puerta principal abierta",
-        "door": state.doors["principal"],
-    }
-
-
-@app.get("/principal/close")
-def principal_close():
-    state.doors["principal"].is_open = False
-    state.doors["principal"].last_update = now()
-    send_command_to_esp("/principal/close")
-    return {
-        "message": "Puerta principal cerrada",
-        "door": state.doors["principal"],
-    }
+    await refresh_state()
+    body = _status_cache or _rebuild_status()
+    headers = {"ETag": _status_etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    if _etag_matches(request, _status_etag):
+        return Response(status_code=304, headers=headers)
+    if accepts_gzip(request.headers.get("accept-encoding", "")):
+        # Ya va comprimido: GZipMiddleware no lo vuelve a tocar
+        headers["Content-Encoding"] = "gzip"
+        body = _status_gzipped(body)
+    return Response(content=body, media_type="application/json", headers=headers)
 
 
 # ==========================
-# PUERTA GARAGE (ESP: /garage/open y /garage/close)
+# ACCIONES SIMPLES: PUERTAS, LUCES, PIR Y ULTRASONIDO
+# (ESP: /principal/open, /garage/close, /cocina/on, /pir/off, /ultra/on, ...)
 # ==========================
 
-@app.get("/garage/open")
-def garage_open():
-    state.doors["garage"].is_open = True
-    state.doors["garage"].last_update = now()
-    state.modo_seguro = False
-    send_command_to_esp("/garage/open")
-    return {
-        "message": "Puerta garage abierta",
-        "door": state.doors["garage"],
-    }
-
-
-@app.get("/garage/close")
-def garage_close():
-    state.doors["garage"].is_open = False
-    state.doors["garage"].last_update = now()
-    send_command_to_esp("/garage/close")
-    return {
-        "message": "Puerta garage cerrada",
-        "door": state.doors["garage"],
-    }
+# (dispositivo, acción, objeto de estado, atributo, valor, mensaje, clave de respuesta)
+ACTIONS = [
+    ("principal", "open", PRINCIPAL, "is_open", True, "Puerta principal abierta", "door"),
+    ("principal", "close", PRINCIPAL, "is_open", False, "Puerta principal cerrada", "door"),
+    ("garage", "open", GARAGE, "is_open", True, "Puerta garage abierta", "door"),
+    ("garage", "close", GARAGE, "is_open", False, "Puerta garage cerrada", "door"),
+    ("ultra", "on", ULTRA, "active", True, "Ultrasonido activado", "ultra"),
+    ("ultra", "off", ULTRA, "active", False, "Ultrasonido desactivado", "ultra"),
+    ("cocina", "on", COCINA, "is_on", True, "Luz cocina encendida", "light"),
+    ("cocina", "off", COCINA, "is_on", False, "Luz cocina apagada", "light"),
+    ("sala", "on", SALA, "is_on", True, "Luz sala encendida", "light"),
+    ("sala", "off", SALA, "is_on", False, "Luz sala apagada", "light"),
+    ("dorm", "on", DORM, "is_on", True, "Luz dormitorio encendida", "light"),
+    ("dorm", "off", DORM, "is_on", False, "Luz dormitorio apagada", "light"),
+    ("pir", "on", PIR, "active", True, "PIR activado", "pir"),
+    ("pir", "off", PIR, "active", False, "PIR desactivado", "pir"),
+]
+
+
+def make_handler(path, device, target, attr, value, message, response_key):
+    """
+    Crea el handler de una acción simple: actualiza el estado,
+    encola el comando para el ESP32 y responde.
+    """
+    # Abrir una puerta saca a la casa del modo seguro
+    leaves_safe_mode = response_key == "door" and value
+    key = f"house:{device}"
+
+    async def handler():
+        ts = now()
+        setattr(target, attr, value)
+        target.last_update = ts
+        updates = {key: {attr: value, "last_update": ts}}
+        if leaves_safe_mode:
+            set_modo_seguro(False, ts)
+            updates["house"] = {"modo_seguro": False, "last_update": ts}
+        _invalidate_status()
+        events = [{"type": response_key, "key": device, **msgspec.structs.asdict(target)}]
+        if leaves_safe_mode:
+            events.append({"type": "modo_seguro", "modo_seguro": False})
+        enqueue_command(path)
+        await persist(updates, *events)
+        return MsgspecJSONResponse({
+            "message": message,
+            response_key: target,
+        })
+
+    return handler
+
+
+for device, verb, target, attr, value, message, response_key in ACTIONS:
+    path = f"/{device}/{verb}"
+    app.add_api_route(
+        path,
+        make_handler(path, device, target, attr, value, message, response_key),
+        methods=["GET"],
+        response_model=None,
+        name=f"{device}_{verb}",
+    )
 
 
 # ==========================
-# ULTRASONIDO (ESP: /ultra/on y /ultra/off)
+# ULTRASONIDO: DISTANCIA  (extra para backend)
 # ==========================
 
-@app.get("/ultra/on")
-def ultra_on():
-    state.ultra.active = True
-    state.ultra.last_update = now()
-    send_command_to_esp("/ultra/on")
-    return {
-        "message": "Ultrasonido activado",
-        "ultra": state.ultra,
-    }
-
-
-@app.get("/ultra/off")
-def ultra_off():
-    state.ultra.active = False
-    state.ultra.last_update = now()
-    send_command_to_esp("/ultra/off")
-    return {
-        "message": "Ultrasonido desactivado",
-        "ultra": state.ultra,
-    }
-
-
 class UltraDistanceUpdate(BaseModel):
     distance_cm: float
 
 
-@app.post("/ultra/distance")
-def ultra_update_distance(data: UltraDistanceUpdate):
+@app.post("/ultra/distance", response_model=None)
+async def ultra_update_distance(data: UltraDistanceUpdate):
     """
     Endpoint para que el ESP32 envíe la última distancia medida.
     (No existe en el Arduino original, es extra para tu backend)
     """
-    state.ultra.last_distance_cm = data.distance_cm
-    state.ultra.last_update = now()
-    return {
+    ts = now()
+    ULTRA.last_distance_cm = data.distance_cm
+    ULTRA.last_update = ts
+    _invalidate_status()
+    await persist(
+        {"house:ultra": {"last_distance_cm": data.distance_cm, "last_update": ts}},
+        {"type": "ultra", "key": "ultra", **msgspec.structs.asdict(ULTRA)},
+    )
+    return MsgspecJSONResponse({
         "message": "Distancia actualizada",
-        "ultra": state.ultra,
-    }
-
-
-# ==========================
-# LUCES (ESP: /cocina/on, /cocina/off, /sala/on, /sala/off, /dorm/on, /dorm/off)
-# ==========================
-
-@app.get("/cocina/on")
-def cocina_on():
-    light = state.lights["cocina"]
-    light.is_on = True
-    light.last_update = now()
-    send_command_to_esp("/cocina/on")
-    return {
-        "message": "Luz cocina encendida",
-        "light": light,
-    }
-
-
-@app.get("/cocina/off")
-def cocina_off():
-    light = state.lights["cocina"]
-    light.is_on = False
-    light.last_update = now()
-    send_command_to_esp("/cocina/off")
-    return {
-        "message": "Luz cocina apagada",
-        "light": light,
-    }
-
-
-@app.get("/sala/on")
-def sala_on():
-    light = state.lights["sala"]
-    light.is_on = True
-    light.last_update = now()
-    send_command_to_esp("/sala/on")
-    return {
-        "message": "Luz sala encendida",
-        "light": light,
-    }
-
-
-@app.get("/sala/off")
-def sala_off():
-    light = state.lights["sala"]
-    light.is_on = False
-    light.last_update = now()
-    send_command_to_esp("/sala/off")
-    return {
-        "message": "Luz sala apagada",
-        "light": light,
-    }
-
-
-@app.get("/dorm/on")
-def dorm_on():
-    light = state.lights["dorm"]
-    light.is_on = True
-    light.last_update = now()
-    send_command_to_esp("/dorm/on")
-    return {
-        "message": "Luz dormitorio encendida",
-        "light": light,
-    }
-
-
-@app.get("/dorm/off")
-def dorm_off():
-    light = state.lights["dorm"]
-    light.is_on = False
-    light.last_update = now()
-    send_command_to_esp("/dorm/off")
-    return {
-        "message": "Luz dormitorio apagada",
-        "light": light,
-    }
-
-
-# ==========================
-# PIR (ESP: /pir/on y /pir/off)
-# ==========================
-
-@app.get("/pir/on")
-def pir_on():
-    state.pir.active = True
-    state.pir.last_update = now()
-    send_command_to_esp("/pir/on")
-    return {
-        "message": "PIR activado",
-        "pir": state.pir,
-    }
-
-
-@app.get("/pir/off")
-def pir_off():
-    state.pir.active = False
-    state.pir.last_update = now()
-    send_command_to_esp("/pir/off")
-    return {
-        "message": "PIR desactivado",
-        "pir": state.pir,
-    }
+        "ultra": ULTRA,
+    })
 
 
 # ==========================
@@ -375,56 +687,134 @@ class DhtUpdate(BaseModel):
     humidity: float
 
 
-@app.post("/dht/update")
-def dht_update(data: DhtUpdate):
+@app.post("/dht/update", response_model=None)
+async def dht_update(data: DhtUpdate):
     """
     Endpoint para que el ESP32 mande los valores de temperatura y humedad.
     """
-    state.dht.temperature = data.temperature
-    state.dht.humidity = data.humidity
-    state.dht.last_update = now()
-    return {
+    ts = now()
+    DHT.temperature = data.temperature
+    DHT.humidity = data.humidity
+    DHT.last_update = ts
+    _invalidate_status()
+    await persist({"house:dht": {
+        "temperature": data.temperature,
+        "humidity": data.humidity,
+        "last_update": ts,
+    }}, {"type": "dht", "key": "dht", **msgspec.structs.asdict(DHT)})
+    return MsgspecJSONResponse({
         "message": "DHT actualizado",
-        "dht": state.dht,
-    }
+        "dht": DHT,
+    })
 
 
-@app.get("/dht", response_model=DhtState)
-def dht_get():
+@app.get("/dht", response_model=None)
+async def dht_get(request: Request):
     """
     Leer los últimos valores de DHT guardados.
+    Responde 304 si no hubo lecturas nuevas desde el ETag del cliente.
     """
-    return state.dht
+    await refresh_state()
+    headers = {"Cache-Control": "no-cache"}
+    if DHT.last_update is not None:  # sin lecturas todavía no hay ETag
+        etag = f'W/"{DHT.last_update.isoformat()}"'
+        headers["ETag"] = etag
+        if _etag_matches(request, etag):
+            return Response(status_code=304, headers=headers)
+    return MsgspecJSONResponse(DHT, headers=headers)
 
 
 # ==========================
 # MODO SEGURO (ESP: /modo/seguro)
 # ==========================
 
-@app.get("/modo/seguro")
-def modo_seguro():
+@app.get("/modo/seguro", response_model=None)
+async def modo_seguro():
+    ts = now()  # mismo timestamp para todos los cambios
+
     # Apagar luces
     for light in state.lights.values():
         light.is_on = False
-        light.last_update = now()
+        light.last_update = ts
 
     # Cerrar puertas
     for door in state.doors.values():
         door.is_open = False
-        door.last_update = now()
+        door.last_update = ts
 
     # Activar PIR, desactivar ultra
-    state.pir.active = True
-    state.pir.last_update = now()
+    PIR.active = True
+    PIR.last_update = ts
+
+    ULTRA.active = False
+    ULTRA.last_update = ts
+
+    set_modo_seguro(True, ts)
+    _invalidate_status()
+
+    off = {"is_on": False, "last_update": ts}
+    closed = {"is_open": False, "last_update": ts}
+    await persist({
+        "house:cocina": off,
+        "house:sala": off,
+        "house:dorm": off,
+        "house:principal": closed,
+        "house:garage": closed,
+        "house:pir": {"active": True, "last_update": ts},
+        "house:ultra": {"active": False, "last_update": ts},
+        "house": {"modo_seguro": True, "last_update": ts},
+    }, {"type": "status", "status": state})
+
+    enqueue_command("/modo/seguro")
+
+    return MsgspecJSONResponse({
+        "message": "MODO SEGURO ACTIVADO",
+        "status": state,
+    })
+
 
-    state.ultra.active = False
-    state.ultra.last_update = now()
+# ==========================
+# WEBSOCKET DE CAMBIOS (/ws)
+# ==========================
 
-    state.modo_seguro = True
+@app.websocket("/ws")
+async def ws_state(websocket: WebSocket):
+    """
+    Canal de avisos: después de cada cambio se manda un mensaje como
+    {"type": "door", "key": "principal", "is_open": true, ...}.
+    El estado inicial se pide a /status.
+    """
+    await websocket.accept()
+    connected.add(websocket)
+    try:
+        while True:
+            await websocket.receive_text()  # solo para detectar la desconexión
+    except WebSocketDisconnect:
+        pass
+    finally:
+        connected.discard(websocket)
 
-    send_command_to_esp("/modo/seguro")
 
-    return {
-        "message": "MODO SEGURO ACTIVADO",
-        "status": state,
-    }
+# ==========================
+# ARRANQUE LOCAL
+# ==========================
+# Equivale a:
+#   uvicorn main:app --loop auto --http httptools --workers 1 \
+#       --limit-concurrency 1000 --timeout-keep-alive 30
+# Sin REDIS_URL el estado vive en memoria de cada proceso: con más de un
+# worker cada uno tendría su propia copia, por eso WEB_CONCURRENCY es 1 por
+# defecto. Con REDIS_URL se puede subir a la cantidad de CPUs.
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "8000")),
+        loop="auto",  # uvloop si está instalado (no existe en Windows)
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", "1")),
+        limit_concurrency=1000,
+        timeout_keep_alive=30,
+    )